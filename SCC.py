@@ -3,121 +3,335 @@
 # Requires: numpy, pyopencl, working OpenCL driver
 
 import math, os, sys, struct
+from array import array
+from functools import lru_cache
 import numpy as np
 import pyopencl as cl
 
 # ---------- host helpers ----------
+def _crc16_byte(crc: int) -> int:
+    for _ in range(8):
+        crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+    return crc
+
+_CRC16_TAB = array("H", (_crc16_byte(i << 8) for i in range(256)))
+
 def crc16_ccitt(data: bytes, crc: int = 0xFFFF) -> int:
+    tab = _CRC16_TAB
     for b in data:
-        crc ^= b << 8
-        for _ in range(8):
-            crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        crc = ((crc << 8) ^ tab[((crc >> 8) ^ b) & 0xFF]) & 0xFFFF
+    return crc
+
+_CRC16_TAB_NP = np.array(_CRC16_TAB, dtype=np.uint16)
+
+def crc16_ccitt_blocks(blocks: np.ndarray) -> np.ndarray:
+    """CRC-16-CCITT of every row of a (nblocks, N) uint8 array."""
+    crc = np.full(blocks.shape[0], 0xFFFF, dtype=np.uint16)
+    for k in range(blocks.shape[1]):
+        idx = ((crc >> 8) ^ blocks[:, k]).astype(np.uint8)
+        crc = (crc << 8) ^ _CRC16_TAB_NP[idx]
     return crc
 
 
 # ---------- kernel template ----------
+TILE_K = 16                                       # candidates tested per work-item
+
 KERNEL_TMPL = r"""
+// segment length, alphabet size, candidates per work-item (a tile of the
+// last byte), tiles per prefix, work-items per block (grid padded past ITEMS)
+#define N     %(N)d
+#define R     %(R)d
+#define K     %(K)d
+#define TILES %(tiles)d
+#define ITEMS %(items)dUL
+
+__constant ushort crc16_tab[256] = { %(crc16_tab)s };
+
 __kernel void brute_crc_sum(
         __global const ushort *crc_targets,
         __global const ushort *sum_targets,
         __global       int   *hit_gid,
-        const uint blocks, const uint N)
+        __constant     uchar *alpha,              // allowed byte values
+        const uint blocks)
 {
-    const uint gid   = get_global_id(0);          // candidate id
-    const uint mask  = (1u << (8*N)) - 1;         // max candidates per launch
+    const uint wid   = get_global_id(0);          // prefix * TILES + tile
     const uint blkid = get_global_id(1);          // which block we solve
     if (blkid >= blocks) return;
 
-    // Decode gid -> byte sequence
-    uchar seq[4];                                 // supports N ≤ 4
-    uint val = gid & mask;
-    for (int i=N-1;i>=0;--i){ seq[i] = val & 0xff; val >>= 8; }
-
-    // CRC-16-CCITT
-    ushort crc = 0xFFFF;
-    for (uint i=0;i<N;++i){
-        crc ^= (ushort)seq[i] << 8;
-        for (int j=0;j<8;++j)
-            crc = (crc & 0x8000)? (ushort)((crc<<1)^0x1021) : (ushort)(crc<<1);
-    }
+    // Early exit: a smaller candidate already solved this block. One slot per
+    // work-group, so the host always launches with local size (x, 1).
+    __local int seen;
+    if (get_local_id(0)==0) seen = hit_gid[blkid];
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (wid >= ITEMS) return;
+
+    // Candidate id = prefix * R + last digit; this item covers K last digits
+    const uint prefix = wid / TILES;
+    const uint first  = (wid %% TILES) * K;
+    if ((int)(prefix*R + first) > seen) return;
 
-    ushort sum = 0; for(uint i=0;i<N;++i) sum += seq[i];
+    // Decode prefix -> leading N-1 bytes (base R digits over the alphabet)
+    uchar seq[N];                                 // register resident, N ≤ 4
+    uint val = prefix;
+    #pragma unroll
+    for (int i=N-2;i>=0;--i){ seq[i] = alpha[val %% R]; val /= R; }
 
-    if (crc==crc_targets[blkid] && sum==sum_targets[blkid])
-        atomic_min(&hit_gid[blkid], (int)gid);
+    // CRC-16-CCITT and sum of the shared prefix, computed once per tile
+    ushort crc = 0xFFFF, sum = 0;
+    #pragma unroll
+    for (int i=0;i<N-1;++i){
+        crc = (ushort)(crc<<8) ^ crc16_tab[(crc>>8) ^ seq[i]];
+        sum += seq[i];
+    }
+
+    const ushort crc_t = crc_targets[blkid], sum_t = sum_targets[blkid];
+    const uint   last  = min(first + K, (uint)R);
+    for (uint d=first; d<last; ++d){
+        const uchar  b = alpha[d];
+        const ushort c = (ushort)(crc<<8) ^ crc16_tab[(crc>>8) ^ b];
+        if (c==crc_t && (ushort)(sum + b)==sum_t){
+            // smallest id wins (matches host LUT)
+            atomic_min(&hit_gid[blkid], (int)(prefix*R + d));
+            return;                               // later d in this tile are larger
+        }
+    }
 }
 """
 
+_CRC16_TAB_CL = ", ".join("0x%04X" % v for v in _CRC16_TAB)
+
+def kernel_items(N: int, R: int) -> int:
+    """Work-items per block: one per (prefix, tile of TILE_K last bytes)."""
+    return R**(N-1) * -(-R // TILE_K)
+
+def kernel_source(N: int, R: int) -> str:
+    """KERNEL_TMPL specialised for segment length N and alphabet size R."""
+    return KERNEL_TMPL % {"N": N, "R": R, "K": TILE_K, "tiles": -(-R // TILE_K),
+                          "items": kernel_items(N, R), "crc16_tab": _CRC16_TAB_CL}
+
 # ---------- codec class ----------
+FORMAT_VERSION = 0x82                             # high bit set: baseline blobs began with N (1-4)
+FULL_ALPHABET  = bytes(range(256))
+PRINTABLE      = bytes(range(0x20, 0x7F))         # ASCII printable
+HOST_LUT_MAX   = 256**2                           # candidates solved on host, not GPU
+LOCAL_SIZES    = (64, 128, 256, 512, 1024)        # work-group sizes tried by the tuner
+BATCH_BLOCKS   = 4096                             # blocks per pipelined GPU launch
+_UNTUNED       = object()                         # local size not probed yet
+
+def _normalize_alphabet(alphabet: bytes) -> bytes:
+    # NUL is always allowed: it pads the final block
+    return bytes(sorted(set(alphabet) | {0}))
+
+def _parse_header(blob: bytes):
+    """Return (N, alphabet, body offset) from a compressed blob."""
+    if len(blob) < 3 or blob[0] != FORMAT_VERSION:
+        raise ValueError("not a compressed blob of this format version")
+    N, R = blob[1], blob[2] or 256
+    if N < 1 or N > 4:
+        raise ValueError("bad segment length in header")
+    if R == 256:
+        return N, FULL_ALPHABET, 3
+    if len(blob) < 3 + R:
+        raise ValueError("truncated header: alphabet cut short")
+    alphabet = bytes(blob[3:3+R])
+    if alphabet != _normalize_alphabet(alphabet):
+        raise ValueError("corrupt header: alphabet not sorted, unique and NUL-led")
+    return N, alphabet, 3 + R
+
 class GPUCRCCodec:
-    def __init__(self, seg_len: int):
+    def __init__(self, seg_len: int, alphabet: bytes = FULL_ALPHABET):
         if seg_len < 1 or seg_len > 4:
             raise ValueError("seg_len 1-4 only (kernel supports ≤4)")
         self.N   = seg_len
+        self.alphabet = _normalize_alphabet(alphabet)
+        self.R   = len(self.alphabet)
+        if self.R**self.N > 0x7FFFFFFF:           # ids live in int hit_gid; 0x7FFFFFFF = unsolved
+            raise ValueError("R**N candidates exceed 31-bit ids; "
+                             "use a smaller alphabet or seg_len")
+        self._alpha_np = np.frombuffer(self.alphabet, dtype=np.uint8)
+        self.ctx = None                           # OpenCL set up on first GPU solve
+        self._lut = None
+        self._lsz = _UNTUNED                      # tuned on first GPU solve
+
+    def _init_gpu(self):
+        # host-LUT codecs (R**N <= HOST_LUT_MAX) never get here: no context, no JIT
         self.ctx = cl.create_some_context()
-        self.q   = cl.CommandQueue(self.ctx)
-        self.prg = cl.Program(self.ctx, KERNEL_TMPL).build()
+        self.q   = self._queue(self.ctx)
+        self.prg = cl.Program(self.ctx, kernel_source(self.N, self.R)).build()
+        self.knl = self.prg.brute_crc_sum
+        self.alpha_dev = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                   hostbuf=self._alpha_np)
+
+    @staticmethod
+    def _queue(ctx):
+        props = cl.command_queue_properties
+        try:                                      # lets batch i+1 upload while i computes
+            return cl.CommandQueue(ctx, properties=props.PROFILING_ENABLE
+                                                   | props.OUT_OF_ORDER_EXEC_MODE_ENABLE)
+        except cl.Error:                          # device has no out-of-order support
+            return cl.CommandQueue(ctx, properties=props.PROFILING_ENABLE)
+
+    # ---------- host lookup table ----------
+    def _decode(self, gids: np.ndarray) -> np.ndarray:
+        """Candidate ids -> (len(gids), N) byte sequences, in the kernel's order."""
+        val  = gids.astype(np.int64)
+        seqs = np.empty((len(val), self.N), dtype=np.uint8)
+        for i in range(self.N-1, -1, -1):
+            seqs[:, i] = self._alpha_np[val % self.R]
+            val //= self.R
+        return seqs
+
+    def _build_lut(self):
+        """Sorted (crc << 16 | sum) keys and the smallest gid producing each."""
+        seqs = self._decode(np.arange(self.R**self.N))
+        keys = (crc16_ccitt_blocks(seqs).astype(np.uint32) << 16
+                | seqs.sum(axis=1, dtype=np.uint16))
+        keys, first = np.unique(keys, return_index=True)   # first hit == kernel's min
+        return keys, first.astype(np.int32)
+
+    def _brute_force(self, crc_t: np.ndarray, sum_t: np.ndarray) -> np.ndarray:
+        if self._lut is None:
+            self._lut = self._build_lut()
+        keys, gids = self._lut
+        want = crc_t.astype(np.uint32) << 16 | sum_t
+        pos  = np.minimum(np.searchsorted(keys, want), len(keys) - 1)
+        return np.where(keys[pos] == want, gids[pos], 0x7FFFFFFF).astype(np.int32)
 
     # ---------- compression ----------
     def compress(self, payload: bytes) -> bytes:
-        hdr = struct.pack(">B", self.N)           # header: N
-        body = bytearray()
-        for i in range(0, len(payload), self.N):
-            block = payload[i:i+self.N].ljust(self.N, b"\x00")
-            body += struct.pack(">HH", crc16_ccitt(block), sum(block) & 0xFFFF)
-        return hdr + body
+        # header: version, N, R (0 = 256), then the alphabet unless it is full
+        hdr = struct.pack(">BBB", FORMAT_VERSION, self.N, self.R & 0xFF)
+        if self.R < 256:
+            hdr += self.alphabet
+        nblocks = -(-len(payload) // self.N)
+        arr = np.zeros(nblocks * self.N, dtype=np.uint8)
+        arr[:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+        if self.R < 256 and not np.isin(arr, self._alpha_np).all():
+            raise ValueError("payload contains bytes outside the alphabet")
+        arr = arr.reshape(nblocks, self.N)
+        # write records straight into the preallocated output, big-endian
+        out = bytearray(len(hdr) + 4 * nblocks)
+        out[:len(hdr)] = hdr
+        rec = np.frombuffer(out, dtype=">u2", offset=len(hdr)).reshape(nblocks, 2)
+        rec[:, 0] = crc16_ccitt_blocks(arr)
+        rec[:, 1] = arr.sum(axis=1, dtype=np.uint16)   # wraps mod 2**16
+        return bytes(out)
 
     # ---------- decompression ----------
     def decompress(self, blob: bytes) -> bytes:
-        N = blob[0]
+        N, alphabet, off = _parse_header(blob)
         if N != self.N:
             raise ValueError("segment length mismatch")
+        if alphabet != self.alphabet:
+            raise ValueError("alphabet mismatch")
 
-        crc_arr = []
-        sum_arr = []
-        off = 1
-        while off < len(blob):
-            crc, s = struct.unpack_from(">HH", blob, off)
-            crc_arr.append(crc); sum_arr.append(s)
-            off += 4
+        nblocks, tail = divmod(len(blob) - off, 4)
+        if tail:
+            raise ValueError("truncated blob: body is not whole (crc, sum) records")
+        # one byteswapping copy (none on big-endian hosts); columns stay views
+        rec = np.frombuffer(blob, dtype=">u2", count=nblocks*2, offset=off)
+        rec = rec.astype(np.uint16, copy=False).reshape(nblocks, 2)
+        crc_arr, sum_arr = rec[:, 0], rec[:, 1]
+        if self.R**self.N <= HOST_LUT_MAX:
+            hit_host = self._brute_force(crc_arr, sum_arr)
+        else:
+            hit_host = self._solve_gpu(crc_arr, sum_arr)
+
+        # rebuild plaintext
+        if np.any(hit_host == 0x7FFFFFFF):
+            raise RuntimeError("some block could not be solved")
+        return self._decode(hit_host).tobytes().rstrip(b"\x00")
+
+    def _solve_gpu(self, crc_arr, sum_arr) -> np.ndarray:
         blocks   = len(crc_arr)
-        crc_dev  = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY  | cl.mem_flags.COPY_HOST_PTR,
-                             hostbuf=np.array(crc_arr, dtype=np.uint16))
-        sum_dev  = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY  | cl.mem_flags.COPY_HOST_PTR,
-                             hostbuf=np.array(sum_arr, dtype=np.uint16))
-        hit_host = np.full(blocks, 0x7FFFFFFF, dtype=np.int32)
-        hit_dev  = cl.Buffer(self.ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR,
-                             hostbuf=hit_host)
-
-        work_items = 256**self.N
-        # Launch 2-D grid:  (candidates per block, blocks)
+        hit_host = np.empty(blocks, dtype=np.int32)
+        if not blocks:
+            return hit_host
+        if self.ctx is None:
+            self._init_gpu()
+        if self._lsz is _UNTUNED:
+            self._lsz = self._tune_local_size()
+
+        # Enqueue every batch up front, chained by events, so the host fills the
+        # next batch's inputs while the device is still busy with earlier ones.
+        pending = []
+        for lo in range(0, blocks, BATCH_BLOCKS):
+            hi = min(lo + BATCH_BLOCKS, blocks)
+            crc_dev, e1 = self._pinned(cl.mem_flags.READ_ONLY,  crc_arr[lo:hi], np.uint16)
+            sum_dev, e2 = self._pinned(cl.mem_flags.READ_ONLY,  sum_arr[lo:hi], np.uint16)
+            hit_dev, e3 = self._pinned(cl.mem_flags.READ_WRITE, 0x7FFFFFFF, np.int32, hi - lo)
+            run = self._launch(hi - lo, self._lsz, crc_dev, sum_dev, hit_dev,
+                               wait_for=[e1, e2, e3])
+            hit_map, done = cl.enqueue_map_buffer(self.q, hit_dev, cl.map_flags.READ,
+                                                  0, (hi - lo,), np.int32,
+                                                  wait_for=[run], is_blocking=False)
+            pending.append((lo, hi, hit_map, done))
+
+        for lo, hi, hit_map, done in pending:
+            done.wait()
+            hit_host[lo:hi] = hit_map
+            hit_map.base.release(self.q)
+        return hit_host
+
+    def _launch(self, blocks, lsz, crc_dev, sum_dev, hit_dev, wait_for=None) -> cl.Event:
+        # round up to whole work-groups
+        work_items = -(-kernel_items(self.N, self.R) // lsz[0]) * lsz[0]
+        # Launch 2-D grid:  (candidate tiles per block, blocks)
         gsz = (work_items, blocks)
-        self.prg.brute_crc_sum(self.q, gsz, None,
-                               crc_dev, sum_dev, hit_dev,
-                               np.uint32(blocks), np.uint32(self.N))
-        cl.enqueue_copy(self.q, hit_host, hit_dev).wait()
+        return self.knl(self.q, gsz, lsz,
+                        crc_dev, sum_dev, hit_dev, self.alpha_dev,
+                        np.uint32(blocks), wait_for=wait_for)
 
-        # rebuild plaintext
-        plain = bytearray()
-        for gid in hit_host:
-            if gid == 0x7FFFFFFF:
-                raise RuntimeError("some block could not be solved")
-            seq = [(gid >> (8*i)) & 0xFF for i in range(self.N)][::-1]
-            plain += bytes(seq)
-        while plain and plain[-1]==0: plain.pop()
-        return bytes(plain)
+    def _tune_local_size(self):
+        """Time a one-block sweep for each of LOCAL_SIZES; return the fastest as (x, 1)."""
+        dev   = self.ctx.devices[0]
+        limit = min(dev.max_work_group_size,
+                    self.knl.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, dev))
+        crc_dev, e1 = self._pinned(cl.mem_flags.READ_ONLY,  [0],      np.uint16)
+        sum_dev, e2 = self._pinned(cl.mem_flags.READ_ONLY,  [0xFFFF], np.uint16)  # > 4*255: never hit
+        # largest power of two within the limit: never let the driver pick a
+        # local size with y > 1, which would race on the kernel's __local seen
+        best, best_t = (1 << (limit.bit_length() - 1), 1), math.inf
+        for lsz in LOCAL_SIZES:
+            if lsz > limit:
+                break
+            hit_dev, e3 = self._pinned(cl.mem_flags.READ_WRITE, 0x7FFFFFFF, np.int32, 1)
+            evt = self._launch(1, (lsz, 1), crc_dev, sum_dev, hit_dev, wait_for=[e1, e2, e3])
+            evt.wait()
+            t = evt.profile.end - evt.profile.start
+            if t < best_t:
+                best, best_t = (lsz, 1), t
+        return best
+
+    def _pinned(self, flags, values, dtype, count=None):
+        """Device buffer backed by pinned host memory, filled through a mapping.
+
+        Returns ``(buffer, event)``; the event marks the unmap and must be waited
+        on before the buffer is used on the out-of-order queue.
+        """
+        count = len(values) if count is None else count
+        buf = cl.Buffer(self.ctx, flags | cl.mem_flags.ALLOC_HOST_PTR,
+                        size=count * np.dtype(dtype).itemsize)
+        host, _ = cl.enqueue_map_buffer(self.q, buf, cl.map_flags.WRITE_INVALIDATE_REGION,
+                                        0, (count,), dtype)
+        host[:] = values
+        return buf, host.base.release(self.q)
 
 
 # ---------- file helpers ----------
-def compress_file(src: str, dst: str, seg_len=2):
-    codec = GPUCRCCodec(seg_len)
+@lru_cache(maxsize=8)
+def _get_codec(seg_len: int, alphabet: bytes = FULL_ALPHABET) -> GPUCRCCodec:
+    return GPUCRCCodec(seg_len, alphabet)
+
+def compress_file(src: str, dst: str, seg_len=2, alphabet=FULL_ALPHABET):
+    codec = _get_codec(seg_len, _normalize_alphabet(bytes(alphabet)))   # same key as decompress
     with open(src, "rb") as f: raw = f.read()
     with open(dst, "wb") as f: f.write(codec.compress(raw))
 
 def decompress_file(src: str, dst: str):
     with open(src, "rb") as f: blob = f.read()
-    seg_len = blob[0]
-    codec   = GPUCRCCodec(seg_len)
+    seg_len, alphabet, _ = _parse_header(blob)
+    codec   = _get_codec(seg_len, alphabet)
     with open(dst, "wb") as f: f.write(codec.decompress(blob))
 
 